@@ -36,6 +36,7 @@ class _HSFrontier(_Frontier):
                 interval=self.batch_interval,
                 qsize=self.batch_qsize,
                 content_encoding=self.batch_content_encoding,
+                compression_level=self.batch_compression_level,
                 callback=partial(self._writer_callback, key),
             )
             self._writers[key] = writer
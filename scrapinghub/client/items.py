@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from .proxy import _ItemsResourceProxy, _DownloadableProxyMixin
 
@@ -67,6 +69,12 @@ class Items(_DownloadableProxyMixin, _ItemsResourceProxy):
           File "<stdin>", line 1, in <module>
         StopIteration
 
+    - download items of a large job over several connections, each one
+      fetching a range of item offsets::
+
+        >>> for item in job.items.iter_parallel(workers=4):
+        ...     print(item)
+
     - retrieve 1 item with multiple filters::
 
         >>> filters = [("size", ">", [30000]), ("size", "<", [40000])]
@@ -129,3 +137,59 @@ class Items(_DownloadableProxyMixin, _ItemsResourceProxy):
                 break
             if len(items) < chunksize:
                 break
+
+    def iter_parallel(self, workers=4, ordered=True, chunksize=10000,
+                      start=0, count=None, **kwargs):
+        """Iterate over items fetching ranges of them concurrently.
+
+        The range of item offsets, from the job stats totals, is split in
+        ranges of `chunksize` items which are downloaded by `workers`
+        threads, keeping at most two ranges per worker in memory.
+
+        Filters are not supported, as ranges are made of item offsets.
+
+        :param workers: number of concurrent downloads.
+        :param ordered: yield items in offset order, otherwise in the order
+            ranges are downloaded.
+        :param chunksize: number of items of each range.
+        :param start: offset of the first item.
+        :param count: overall number of items to be returned.
+
+        :return: an iterator over items.
+        :rtype: :class:`collections.abc.Iterable`
+        """
+        for param in ('filter', 'startts', 'endts', 'startafter'):
+            if param in kwargs:
+                raise ValueError(
+                    'iter_parallel does not support {}'.format(param))
+        total = self.stats().get('totals', {}).get('input_values', 0)
+        end = total if count is None else min(total, start + count)
+        ranges = iter(range(start, end, chunksize))
+
+        def fetch(offset):
+            return list(self.iter(count=min(chunksize, end - offset),
+                                  start='{}/{}'.format(self.key, offset),
+                                  **kwargs))
+
+        executor = ThreadPoolExecutor(workers)
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < workers * 2:
+                    offset = next(ranges, None)
+                    if offset is None:
+                        break
+                    pending.append(executor.submit(fetch, offset))
+                if not pending:
+                    break
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    future = done.pop()
+                    pending.remove(future)
+                for item in future.result():
+                    yield item
+        finally:
+            # Don't wait for running fetches when the consumer stops early
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 
 import json
+from threading import Event, Lock, Thread
+
+from six.moves.queue import Queue, Full
 
 from ..hubstorage.job import JobMeta as _JobMeta
 from ..hubstorage.job import Items as _Items
@@ -394,6 +397,82 @@ class Jobs(object):
         update_kwargs(params, start=start, startafter=start_after, count=count)
         return self._project.spiders.lastjobsummary(spider_id, **params)
 
+    def iter_items(self, keys=None, workers=8, buffer_size=1000,
+                   items_params=None, **params):
+        """Iterate over items of many jobs downloading them concurrently.
+
+        Each of the `workers` threads downloads the items of one job at a
+        time, so items of a job are in order, but items of different jobs are
+        interleaved. At most `buffer_size` downloaded items wait to be
+        consumed.
+
+        :param keys: (optional) an iterable of job keys, by default the
+            jobs returned by :meth:`iter` for the given `params`.
+        :param workers: number of jobs downloaded concurrently.
+        :param buffer_size: max number of downloaded items kept in memory.
+        :param items_params: (optional) a dict of params passed to
+            :meth:`~scrapinghub.client.items.Items.iter` for each job.
+        :param params: (optional) filter params of :meth:`iter`.
+
+        :return: a generator object over ``(job_key, item)`` tuples.
+        :rtype: :class:`types.GeneratorType[tuple]`
+
+        Usage::
+
+            >>> for key, item in project.jobs.iter_items(
+            ...         spider='spider1', state='finished', workers=16):
+            ...     print(key, item)
+        """
+        if keys is None:
+            keys = (job['key'] for job in self.iter(**params))
+        keys = iter(keys)
+        items_params = items_params or {}
+        queue = Queue(buffer_size)
+        lock = Lock()
+        stop = Event()
+        done = object()
+
+        def put(entry):
+            while not stop.is_set():
+                try:
+                    return queue.put(entry, timeout=0.1)
+                except Full:
+                    pass
+
+        def download():
+            try:
+                while not stop.is_set():
+                    with lock:
+                        key = next(keys, None)
+                    if key is None:
+                        break
+                    job = self.get(key)
+                    for item in job.items.iter(**items_params):
+                        if stop.is_set():
+                            break
+                        put((job.key, item))
+            except Exception as exc:
+                put((done, exc))
+            else:
+                put((done, None))
+
+        threads = [Thread(target=download) for _ in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            running = workers
+            while running:
+                key, item = queue.get()
+                if key is not done:
+                    yield key, item
+                    continue
+                running -= 1
+                if item is not None:
+                    raise item
+        finally:
+            stop.set()
+
     def _extract_spider_id(self, spider):
         if not spider and self.spider:
             return self.spider._id
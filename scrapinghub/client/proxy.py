@@ -71,6 +71,18 @@ class _ItemsResourceProxy(_Proxy):
         except _ValueTooLarge as exc:
             raise ValueTooLarge(str(exc))
 
+    def write_many(self, items):
+        """Write new elements to collection in bulk.
+
+        :param items: an iterable of element data dicts to write.
+        :return: a range of the offsets assigned to the elements.
+        :rtype: :class:`range`
+        """
+        try:
+            return self._origin.write_many(items)
+        except _ValueTooLarge as exc:
+            raise ValueTooLarge(str(exc))
+
     def iter(self, _key=None, count=None, **params):
         """Iterate over elements in collection.
 
@@ -84,7 +96,10 @@ class _ItemsResourceProxy(_Proxy):
 
     def flush(self):
         """Flush data from writer threads."""
-        self._origin.flush()
+        try:
+            self._origin.flush()
+        except _ValueTooLarge as exc:
+            raise ValueTooLarge(str(exc))
 
     def stats(self):
         """Get resource stats.
@@ -1,4 +1,10 @@
+import os
+import json
 import time
+import zlib
+import heapq
+import bisect
+import hashlib
 import socket
 import random
 import logging
@@ -6,22 +12,33 @@ import warnings
 import six
 from six.moves import range
 from six.moves.queue import Queue
-from io import BytesIO
-from gzip import GzipFile
-from itertools import count
+from itertools import count, islice
 import requests
 from collections import deque
-from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Thread, Lock, RLock, Condition
 from .utils import xauth, iterqueue, sizeof_fmt
-from .serialization import jsonencode
+from .serialization import mpencode
+
+try:
+    import zstandard
+
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
 
 logger = logging.getLogger('hubstorage.batchuploader')
 
 
 class BatchUploader(object):
 
-    # Wait time between all batches status checks
-    worker_loop_delay = 1.0
+    # Number of threads uploading batches. A writer is handled by a single
+    # thread at a time, so its batches are always uploaded in offset order.
+    worker_threads = 1
+    # Number of threads encoding the next batch of writers while their
+    # current batch is being uploaded, defaults to the number of workers.
+    encoder_threads = None
     # Max number of retry attempts before giving up.
     worker_max_retries = 200
     # The delay increases exponentially with the number of attempts but is
@@ -38,21 +55,74 @@ class BatchUploader(object):
     # - standard deviation = approx. 40m, which means that 95% of the time the
     #   total delay will be within 2*std = 1h20m of the average.
 
-    def __init__(self, client):
+    # Adaptive writers move their batch size towards these upload latency
+    # (in seconds) and raw batch size (in bytes) targets.
+    adaptive_target_latency = 5.0
+    adaptive_target_bytes = 8 * 1024 ** 2
+    # Bounds of the factor applied to the batch size after each upload.
+    adaptive_min_factor = 0.5
+    adaptive_max_factor = 1.5
+
+    def __init__(self, client, workers=None, max_queued_bytes=None,
+                 spool_dir=None, stats_callback=None):
         self.client = client
         self.closed = False
-        self._wait_event = Event()
-        self._writers = deque()
-        self._thread = Thread(target=self._worker)
-        self._thread.daemon = True
-        self._thread.start()
+        # Called with a dict describing each batch once it is uploaded or
+        # given up, to export upload metrics
+        self.stats_callback = stats_callback
+        self._stats = _UploadStats()
+        # Directory where writers keep their items until they are uploaded
+        self.spool_dir = spool_dir
+        # Limit on the size of items buffered by all writers together
+        self.budget = _ByteBudget(max_queued_bytes) if max_queued_bytes \
+            else None
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._live_writers = set()
+        # Writers signaled as ready for a checkpoint, in order
+        self._ready = deque()
+        # Heap of (deadline, timer id, writer) of writers waiting for their
+        # interval to elapse or for an upload retry
+        self._timers = []
+        self._timers_ctr = count()
+        workers = workers or self.worker_threads
+        self._encoder = ThreadPoolExecutor(self.encoder_threads or workers)
+        # Worker threads still running, the last one shuts the encoder down
+        self._running = workers
+        self._threads = []
+        for _ in range(workers):
+            thread = Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
 
     def create_writer(self, url, start=0, auth=None, size=1000, interval=15,
                       qsize=None, content_encoding='identity',
-                      maxitemsize=1024 ** 2, callback=None):
+                      maxitemsize=1024 ** 2, callback=None,
+                      defer_encoding=False, max_batch_bytes=None,
+                      max_queue_bytes=None, compression_level=None,
+                      spool_dir=None, adaptive=False, target_latency=None,
+                      target_batch_bytes=None, use_msgpack=False):
         # callback shouldn't try to inject more items in the queue
         # otherwise it can lead to deadlock on _checkpoint step
+        # defer_encoding moves JSON encoding of items to the uploader, items
+        # must not be modified after being written, and they are not
+        # accounted by the max_queue_bytes and uploader byte limits; writes
+        # return no offset, and errors are raised by flush() and close()
+        # items left in the spool of a previous writer for the same url are
+        # uploaded first, and start is then ignored
+        # use_msgpack serializes items with msgpack instead of JSON lines
+        # adaptive writers tune size between 1 and the queue size from the
+        # upload latency and batch size, and split batches refused with 413
         assert not self.closed, 'Can not create new writers when closed'
+        if content_encoding not in CONTENT_ENCODERS:
+            raise ValueError('Unknown content encoding: %s' % content_encoding)
+        spool_dir = spool_dir or self.spool_dir
+        if spool_dir and defer_encoding:
+            raise ValueError('Spooled writers can not defer encoding')
+        if spool_dir and use_msgpack:
+            raise ValueError('Spooled writers can not use msgpack')
+        spool = _Spool(spool_dir, url, start) if spool_dir else None
         auth = xauth(auth) or self.client.auth
         w = _BatchWriter(url=url,
                          auth=auth,
@@ -62,92 +132,342 @@ class BatchUploader(object):
                          qsize=qsize,
                          maxitemsize=maxitemsize,
                          content_encoding=content_encoding,
+                         compression_level=compression_level,
                          uploader=self,
-                         callback=callback)
-        self._writers.append(w)
+                         callback=callback,
+                         defer_encoding=defer_encoding,
+                         max_batch_bytes=max_batch_bytes,
+                         max_queue_bytes=max_queue_bytes,
+                         spool=spool,
+                         adaptive=adaptive,
+                         target_latency=(target_latency or
+                                         self.adaptive_target_latency),
+                         target_batch_bytes=(target_batch_bytes or
+                                             self.adaptive_target_bytes),
+                         use_msgpack=use_msgpack)
+        with self._lock:
+            self._live_writers.add(w)
+        if spool is not None:
+            lines = spool.replay()
+            for i in range(0, len(lines), w.size):
+                w._enqueue_many(lines[i:i + w.size], spool=False)
         return w
 
     def close(self, timeout=None):
-        self.closed = True
+        with self._lock:
+            self.closed = True
+            writers = list(self._live_writers)
+        # Writers are closed, and dropped by the workers once uploaded
+        for w in writers:
+            w.close(block=False)
         self.interrupt()
-        self._thread.join(timeout)
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            thread.join(timeout)
 
     def interrupt(self):
-        self._wait_event.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return upload metrics of all the writers of the uploader"""
+        with self._lock:
+            writers = list(self._live_writers)
+        stats = self._stats.snapshot()
+        stats.update(
+            writers=len(writers),
+            queue_depth=sum(w.itemsq.qsize() for w in writers),
+            queued_bytes=sum(w.queued_bytes for w in writers),
+            parked=sum(1 for w in writers if w.pending is not None),
+        )
+        return stats
+
+    def _record(self, w, **counters):
+        w._stats.add(**counters)
+        self._stats.add(**counters)
+
+    def _record_error(self, w, error, **counters):
+        w._stats.set_error(error, **counters)
+        self._stats.set_error(error, **counters)
 
     def __del__(self):
         if not self.closed:
             warnings.warn("%r not closed properly, some items may have been "
-                          "lost!: %r" % (self.__class__.__name__, self._writers))
+                          "lost!: %r" % (self.__class__.__name__,
+                                         list(self._live_writers)))
 
-    def _interruptable_sleep(self):
-        self._wait_event.wait(self.worker_loop_delay)
-        self._wait_event.clear()
+    def _notify(self, w):
+        """Signal a writer as ready for a checkpoint"""
+        if w._ready or w._busy:
+            return
+        with self._lock:
+            self._make_ready(w)
 
-    def _worker(self):
-        ctr = count()
-        while True:
-            if not self._writers:
+    def _make_ready(self, w):
+        # Writers waiting to retry a batch are only woken up by their timer
+        if w._ready or w._busy or w.pending is not None:
+            return
+        w._ready = True
+        self._ready.append(w)
+        self._cond.notify()
+
+    def _arm(self, w):
+        """Schedule a checkpoint of a writer once its interval elapses"""
+        if w._timer is not None:
+            return
+        with self._lock:
+            if w._timer is None and not w._ready and not w._busy:
+                self._push_timer(w, time.time() + w.interval)
+
+    def _push_timer(self, w, deadline):
+        w._timer = next(self._timers_ctr)
+        heapq.heappush(self._timers, (deadline, w._timer, w))
+        self._cond.notify()
+
+    def _relieve(self, budget):
+        # Upload items holding a byte budget some writer is waiting for
+        with self._lock:
+            for w in self._live_writers:
+                if budget in w.budgets and not w.itemsq.empty():
+                    self._make_ready(w)
+
+    def _fire_timers(self):
+        """Signal writers whose timer is due, return the time to the next"""
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, timer, w = heapq.heappop(self._timers)
+            # Skip timers replaced or cancelled since they were armed
+            if w._timer == timer:
+                w._timer = None
+                if not (w._ready or w._busy):
+                    w._ready = True
+                    self._ready.append(w)
+        if self._timers:
+            return self._timers[0][0] - now
+
+    def _next_writer(self):
+        with self._cond:
+            while True:
+                timeout = self._fire_timers()
+                if self._ready:
+                    # Take exclusive ownership of the writer, so that no
+                    # other worker uploads its batches out of order
+                    w = self._ready.popleft()
+                    w._ready = False
+                    w._busy = True
+                    w._timer = None
+                    return w
                 # Stop thread if closed and idle, but if open wait for writers
-                if self.closed:
-                    break
-                self._interruptable_sleep()
-                continue
+                if self.closed and not self._live_writers:
+                    return None
+                self._cond.wait(timeout)
 
-            # Delay once all writers are processed
-            if (next(ctr) % len(self._writers) == 0) and not self.closed:
-                self._interruptable_sleep()
+    def _worker(self):
+        while True:
+            w = self._next_writer()
+            if w is None:
+                break
 
-            # Get next writer to process
-            w = self._writers.popleft()
+            try:
+                if w.pending is not None:
+                    # Retry the parked batch once due
+                    self._tryupload(w, w.pending)
+                else:
+                    # Checkpoint writer if eligible
+                    now = time.time()
+                    if w.wants_checkpoint() or \
+                            w.checkpoint <= now - w.interval:
+                        self._checkpoint(w)
+                        w.checkpoint = now
+            except Exception as e:
+                # Never leave the writer owned by a dead thread
+                logger.exception('Failed checkpoint of url=%s', w.url)
+                self._record_error(w, repr(e))
+            finally:
+                self._release(w)
 
-            # Close open writers if uploader is closed
-            if self.closed and not w.closed:
-                w.close(block=False)
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            # No batches are encoded ahead once all the workers are done
+            self._encoder.shutdown(wait=False)
 
-            # Checkpoint writer if eligible
-            now = time.time()
-            if w.itemsq.qsize() >= w.size or w.closed or w.flushme \
-                    or w.checkpoint < now - w.interval:
-                self._checkpoint(w)
-                w.checkpoint = now
+    def _release(self, w):
+        discard = False
+        with self._lock:
+            w._busy = False
+            if w.pending is not None:
+                # Its retry timer is armed already
+                return
+            if w.closed and w.itemsq.empty() and w.prepared is None:
+                self._live_writers.discard(w)
+                self._cond.notify_all()
+                discard = True
+            elif w.wants_checkpoint():
+                self._make_ready(w)
+            elif not w.itemsq.empty():
+                self._push_timer(w, w.checkpoint + w.interval)
+        if discard and w.spool is not None:
+            w.spool.discard()
 
-            # Re-queue pending or open writers
-            if not (w.closed and w.itemsq.empty()):
-                self._writers.append(w)
+    def _schedule_retry(self, w, batch, delay):
+        w.pending = batch
+        with self._lock:
+            self._push_timer(w, time.time() + delay)
 
     def _checkpoint(self, w):
-        q = w.itemsq
-        qiter = iterqueue(q, w.size)
-        data = self._content_encode(qiter, w)
+        if w.prepared is not None:
+            prepared, w.prepared = w.prepared, None
+            batch = prepared.result()
+        else:
+            batch = self._encode_batch(w, w.offset)
+        if batch is None:
+            return
+        # Encode the next batch while the current one is being uploaded,
+        # unless closing, as workers may outlive a close() timeout
+        if w.wants_checkpoint() and not self.closed:
+            w.prepared = self._encoder.submit(
+                self._encode_batch, w, batch['offset'] + batch['count'])
+        self._tryupload(w, batch)
+
+    def _encode_batch(self, w, offset):
+        qiter = iterqueue(w.itemsq, w.size)
+        items, errors, size = qiter, [], [0]
+        if w.defer_encoding:
+            items = w._iterencode(qiter, errors)
+        items = sized = w._itersized(items, size)
+        # Adaptive writers keep the encoded items to split the batch if the
+        # server refuses it as too large
+        lines = [] if w.adaptive else None
+        if lines is not None:
+            items = _itercollect(items, lines)
+        started = time.time()
+        try:
+            data = self._content_encode(items, w)
+        except Exception as e:
+            logger.exception('Non retryable failure encoding url=%s '
+                             'offset=%s', w.url, offset)
+            self._record_error(w, repr(e), failed_batches=1)
+            # Release the items taken from the queue
+            sized.close()
+            if not w.defer_encoding:
+                for budget in w.budgets:
+                    budget.release(size[0])
+            for _ in range(qiter.count):
+                w.itemsq.task_done()
+            return
+        encode_time = time.time() - started
+        if qiter.count:
+            self._record(w, encode_time=encode_time)
+        count = qiter.count - len(errors)
+        if errors:
+            w.errors.extend(errors)
+            if count == 0:
+                for _ in range(qiter.count):
+                    w.itemsq.task_done()
+                return
         if qiter.count > 0:
-            response = self._tryupload({
+            return {
                 'url': w.url,
-                'offset': w.offset,
+                'offset': offset,
+                'count': count,
+                'drained': qiter.count,
+                'size': size[0],
+                'encode_time': encode_time,
                 'data': data,
                 'auth': w.auth,
                 'content-encoding': w.content_encoding,
-            })
-            w.offset += qiter.count
-            if w.callback is not None:
-                try:
-                    w.callback(response)
-                except Exception:
-                    logger.exception("Callback for %s failed", w.url)
-            for _ in range(qiter.count):
-                q.task_done()
+                'content-type': w.content_type,
+                'retries': 0,
+                'lines': lines,
+            }
+
+    def _split_batch(self, w, batch):
+        """Split a batch of an adaptive writer in two halves"""
+        lines = batch['lines']
+        half = len(lines) // 2
+        halves = []
+        for offset, part in ((batch['offset'], lines[:half]),
+                             (batch['offset'] + half, lines[half:])):
+            started = time.time()
+            data = self._content_encode(iter(part), w)
+            halves.append(dict(batch, offset=offset, count=len(part),
+                               drained=len(part), lines=part, retries=0,
+                               size=sum(_datasize(x) + 1 for x in part),
+                               encode_time=time.time() - started, data=data))
+        # Items dropped by deferred encoding are accounted by the last half
+        halves[1]['drained'] = batch['drained'] - half
+        return halves
+
+    def _adapt(self, w, batch, too_large=False):
+        """Move the batch size of an adaptive writer towards its targets"""
+        if too_large:
+            factor = self.adaptive_min_factor
+        else:
+            factor = min(w.target_latency / max(batch['latency'], 1e-3),
+                         w.target_batch_bytes / max(batch['size'], 1))
+            # Batches cut before reaching size say nothing about larger ones
+            if factor > 1 and batch['drained'] < w.size:
+                return
+            factor = min(max(factor, self.adaptive_min_factor),
+                         self.adaptive_max_factor)
+        size = int(min(max(w.size * factor, 1), w.max_size))
+        if size != w.size:
+            logger.debug("Adapting batch size of url=%s from %d to %d",
+                         w.url, w.size, size)
+            w.size = size
+
+    def _batch_done(self, w, batch, response):
+        w.pending = None
+        w.offset += batch['count']
+        if w.spool is not None:
+            w.spool.ack(w.offset)
+        if response is not None:
+            self._record(w, batches=1, items=batch['count'],
+                         raw_bytes=batch['size'],
+                         sent_bytes=len(batch['data']))
+        if w.callback is not None:
+            try:
+                w.callback(response)
+            except Exception:
+                logger.exception("Callback for %s failed", w.url)
+        if self.stats_callback is not None:
+            try:
+                self.stats_callback({
+                    'url': batch['url'],
+                    'offset': batch['offset'],
+                    'count': batch['count'],
+                    'raw_bytes': batch['size'],
+                    'sent_bytes': len(batch['data']),
+                    'encode_time': batch['encode_time'],
+                    'latency': batch.get('latency'),
+                    'retries': batch['retries'],
+                    'status': getattr(response, 'status_code', None),
+                })
+            except Exception:
+                logger.exception("Stats callback for %s failed", w.url)
+        if not w.defer_encoding:
+            for budget in w.budgets:
+                budget.release(batch['size'])
+        for _ in range(batch['drained']):
+            w.itemsq.task_done()
 
     def _content_encode(self, qiter, w):
         ce = w.content_encoding
-        if ce == 'identity':
-            return _encode_identity(qiter)
-        elif ce == 'gzip':
-            return _encode_gzip(qiter)
-        else:
+        try:
+            encoder = CONTENT_ENCODERS[ce]
+        except KeyError:
             raise ValueError('Writer using unknown content encoding: %s' % ce)
+        return encoder(qiter, w.compression_level)
 
-    def _tryupload(self, batch):
-        """Retry uploads in case of server failures
+    def _tryupload(self, w, batch):
+        """Upload a batch, scheduling a retry in case of server failures
+
+        The failed batch is parked until its next attempt is due, so the
+        workers keep uploading batches of other writers meanwhile.
 
         Use polinomial backoff with 10 minutes maximum interval that accounts
         for ~30 hours of total retry time.
@@ -157,35 +477,65 @@ class BatchUploader(object):
         """
         url = batch['url']
         offset = batch['offset']
-        for retryn in range(self.worker_max_retries):
-            emsg = ''
+        retryn = batch['retries']
+        r = None
+        started = time.time()
+        try:
             try:
                 r = self._upload(batch)
-                r.raise_for_status()
-                if not (200 <= r.status_code < 300):
-                    logger.warning('Discarding write to url=%s offset=%s: '
-                                   '[HTTP error %s] %s\n%s', url, offset,
-                                   r.status_code, r.reason, r.text.rstrip())
-                return r
-            except (socket.error, requests.RequestException) as e:
-                if isinstance(e, requests.HTTPError):
-                    emsg = "[HTTP error {0}] {1}".format(e.response.status_code,
-                                                         e.response.text.rstrip())
-                else:
-                    emsg = str(e)
+            finally:
+                batch['latency'] = time.time() - started
+                w._stats.add_latency(batch['latency'])
+                self._stats.add_latency(batch['latency'])
+            r.raise_for_status()
+            if not (200 <= r.status_code < 300):
+                logger.warning('Discarding write to url=%s offset=%s: '
+                               '[HTTP error %s] %s\n%s', url, offset,
+                               r.status_code, r.reason, r.text.rstrip())
+        except (socket.error, requests.RequestException) as e:
+            r = None
+            if isinstance(e, requests.HTTPError):
+                emsg = "[HTTP error {0}] {1}".format(e.response.status_code,
+                                                     e.response.text.rstrip())
+            else:
+                emsg = str(e)
+            if (w.adaptive and isinstance(e, requests.HTTPError) and
+                    e.response.status_code == 413 and
+                    len(batch['lines']) > 1):
+                logger.info("Splitting url=%s offset=%s: %s", url, offset,
+                            emsg)
+                self._adapt(w, batch, too_large=True)
+                first, second = self._split_batch(w, batch)
+                first['next'] = second
+                return self._tryupload(w, first)
+            if retryn + 1 < self.worker_max_retries:
                 logger.info("Retrying url=%s offset=%s: %s", url, offset, emsg)
-            except Exception:
-                logger.exception('Non retryable failure on url=%s offset=%s',
-                                 url, offset)
-                break
-
-            backoff = min(max(retryn ** 2, self.worker_min_interval),
-                          self.worker_max_interval)
-            time.sleep(backoff * (0.5 + random.random()))
+                self._record_error(w, emsg, retries=1)
+                batch['retries'] = retryn + 1
+                backoff = min(max(retryn ** 2, self.worker_min_interval),
+                              self.worker_max_interval)
+                self._schedule_retry(w, batch, backoff * (0.5 + random.random()))
+                return
+            logger.error("Giving up on url=%s offset=%s after %d attempts: %s",
+                         url, offset, self.worker_max_retries, emsg)
+            self._record_error(w, emsg, failed_batches=1)
+        except Exception as e:
+            r = None
+            logger.exception('Non retryable failure on url=%s offset=%s',
+                             url, offset)
+            self._record_error(w, repr(e), failed_batches=1)
+        if w.adaptive and r is not None:
+            self._adapt(w, batch)
+        self._batch_done(w, batch, r)
+        # Upload the other half of a split batch right away
+        if batch.get('next') is not None:
+            self._tryupload(w, batch.pop('next'))
 
     def _upload(self, batch):
         params = {'start': batch['offset']}
         headers = {'content-encoding': batch['content-encoding']}
+        if batch.get('content-type'):
+            headers['content-type'] = batch['content-type']
         return self.client.session.request(
             method='POST',
             url=batch['url'],
@@ -197,6 +547,216 @@ class BatchUploader(object):
         )
 
 
+class _UploadStats(object):
+    """Upload metrics of a writer, or of all the writers of an uploader"""
+
+    #: Upper bounds, in seconds, of the upload latency histogram buckets
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+                       float('inf'))
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = dict.fromkeys((
+            'batches', 'items', 'raw_bytes', 'sent_bytes', 'encode_time',
+            'uploads', 'upload_time', 'retries', 'failed_batches',
+            'blocked_time'), 0)
+        self._latency = [0] * len(self.latency_buckets)
+        self._last_error = None
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in six.iteritems(counters):
+                self._counters[name] += value
+
+    def add_latency(self, latency):
+        bucket = bisect.bisect_left(self.latency_buckets, latency)
+        with self._lock:
+            self._latency[bucket] += 1
+            self._counters['uploads'] += 1
+            self._counters['upload_time'] += latency
+
+    def set_error(self, error, **counters):
+        self.add(**counters)
+        self._last_error = {'time': time.time(), 'error': error}
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['latency'] = list(zip(self.latency_buckets, self._latency))
+        stats['last_error'] = self._last_error
+        return stats
+
+
+class _ItemsQueue(Queue):
+    """Queue of writer items also putting them in bulk"""
+
+    def put_many(self, items, on_full=None):
+        """Put all items, taking the queue lock once while there is room
+
+        on_full is called without holding the lock before blocking on a full
+        queue. Returns the number of seconds it was blocked.
+        """
+        blocked, i = 0, 0
+        while True:
+            with self.not_full:
+                n = len(items) - i
+                if self.maxsize > 0:
+                    n = min(n, self.maxsize - self._qsize())
+                if n > 0:
+                    for data in items[i:i + n]:
+                        self._put(data)
+                    self.unfinished_tasks += n
+                    self.not_empty.notify()
+                    i += n
+                if i == len(items):
+                    return blocked
+            if on_full is not None:
+                on_full()
+            started = time.time()
+            with self.not_full:
+                while self._qsize() >= self.maxsize:
+                    self.not_full.wait()
+            blocked += time.time() - started
+
+
+class _ByteBudget(object):
+    """Block writers while items buffered for upload exceed a size limit
+
+    Sizes are acquired by writers when items are written and released when
+    their batch upload is done. A single item larger than the limit is let
+    through when nothing else is buffered.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.waiting = 0
+        self._cond = Condition()
+
+    def acquire(self, size, on_wait=None):
+        """Acquire size bytes, returning the time spent waiting for them"""
+        started = None
+        with self._cond:
+            while self.used and self.used + size > self.limit:
+                if started is None:
+                    started = time.time()
+                self.waiting += 1
+                try:
+                    if on_wait is not None:
+                        on_wait()
+                    self._cond.wait()
+                finally:
+                    self.waiting -= 1
+            self.used += size
+        return 0 if started is None else time.time() - started
+
+    def release(self, size):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+class _Spool(object):
+    """Append-only file keeping the items of a writer until they are uploaded
+
+    The first line of the file is a JSON header with the url of the writer
+    and the offset of the first spooled item, followed by a line for each
+    item written. The offset of the next item to upload is recorded in an
+    ``.ack`` file next to it after each batch, so that a writer created
+    later for the same url uploads the items that were not acknowledged.
+    """
+
+    #: Rewrite the file once it grows over this size and is fully uploaded
+    compact_size = 64 * 1024 ** 2
+
+    def __init__(self, directory, url, start):
+        name = hashlib.sha1(url.encode('utf8')).hexdigest()
+        self.path = os.path.join(directory, name + '.spool')
+        self.ackpath = os.path.join(directory, name + '.ack')
+        self.url = url
+        self.lock = Lock()
+        self._lines = []
+        if os.path.exists(self.path):
+            self._load()
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._create(start)
+        self._file = open(self.path, 'ab', buffering=0)
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf8'))
+            if header['url'] != self.url:
+                raise ValueError('Spool %s belongs to %s' %
+                                 (self.path, header['url']))
+            end = f.tell()
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self._lines.append(line[:-1].decode('utf8'))
+                end += len(line)
+        if end != os.path.getsize(self.path):
+            # Drop the interrupted write of the last line, so that the next
+            # item is not appended to it
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        self.start = header['start']
+        self.end = self.start + len(self._lines)
+        self.acked = self.start
+        if os.path.exists(self.ackpath):
+            with open(self.ackpath) as f:
+                self.acked = int(f.read())
+        logger.info('Replaying %d items spooled for %s',
+                    self.end - self.acked, self.url)
+
+    def _create(self, start):
+        self.start = self.end = self.acked = start
+        header = json.dumps({'url': self.url, 'start': start})
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write(header.encode('utf8') + b'\n')
+        os.replace(tmppath, self.path)
+        self._write_ack(start)
+
+    def replay(self):
+        """Return the items that were not uploaded, releasing them"""
+        lines, self._lines = self._lines[self.acked - self.start:], []
+        return lines
+
+    def append(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf8')
+        self._file.write(data + b'\n')
+        self.end += 1
+
+    def ack(self, offset):
+        self.acked = offset
+        self._write_ack(offset)
+        if offset == self.end and self._file.tell() > self.compact_size \
+                and self.lock.acquire(False):
+            try:
+                if offset == self.end:
+                    self._file.close()
+                    self._create(offset)
+                    self._file = open(self.path, 'ab', buffering=0)
+            finally:
+                self.lock.release()
+
+    def _write_ack(self, offset):
+        tmppath = self.ackpath + '.tmp'
+        with open(tmppath, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmppath, self.ackpath)
+
+    def discard(self):
+        """Remove the spool once all its items are uploaded"""
+        self._file.close()
+        for path in (self.path, self.ackpath):
+            if os.path.exists(path):
+                os.remove(path)
+
+
 class ValueTooLarge(ValueError):
     """Raised when a serialized item is greater than 1MB"""
 
@@ -206,70 +766,338 @@ class _BatchWriter(object):
     ERRMSG_DATA_TRUNCATION_LEN = 1024
 
     def __init__(self, url, start, auth, size, interval, qsize,
-                 maxitemsize, content_encoding, uploader, callback=None):
+                 maxitemsize, content_encoding, uploader, callback=None,
+                 defer_encoding=False, max_batch_bytes=None,
+                 max_queue_bytes=None, compression_level=None, spool=None,
+                 adaptive=False, target_latency=None, target_batch_bytes=None,
+                 use_msgpack=False):
         self.url = url
+        self.spool = spool
+        if spool is not None:
+            # Continue after the items kept by the spool
+            start = spool.acked
         self.offset = start
-        self._nextid = count(start)
+        self._nextid = count(start if spool is None else spool.end)
+        self._write_lock = RLock()
         self.auth = auth
         self.size = size
         self.interval = interval
         self.maxitemsize = maxitemsize
+        # Batches are cut once their encoded items reach this size
+        self.max_batch_bytes = max_batch_bytes
+        self.queued_bytes = 0
+        self._bytes_lock = Lock()
+        # Limits on the size of items buffered by this writer, and by all
+        # writers of the uploader
+        self.budgets = []
+        if max_queue_bytes:
+            self.budgets.append(_ByteBudget(max_queue_bytes))
+        if uploader.budget is not None:
+            self.budgets.append(uploader.budget)
         self.content_encoding = content_encoding
+        # Items are encoded as JSON text lines, or as msgpack bytes
+        self.use_msgpack = use_msgpack
+        self.content_type = 'application/x-msgpack' if use_msgpack else None
+        self.json_backend = uploader.client.json_backend
+        # None uses the default level of the content encoding
+        self.compression_level = compression_level
         self.checkpoint = time.time()
-        self.itemsq = Queue(size * 2 if qsize is None else qsize)
+        self.itemsq = _ItemsQueue(size * 2 if qsize is None else qsize)
+        # Adaptive writers tune size within 1 and max_size after each upload
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.target_batch_bytes = target_batch_bytes
+        self.max_size = self.itemsq.maxsize or size * 10
         self.closed = False
         self.flushme = False
+        # Batch waiting for an upload retry, if any
+        self.pending = None
+        # Future of the next batch, encoded while the current one is uploaded
+        self.prepared = None
         self.uploader = uploader
+        # Scheduling state, guarded by the uploader lock
+        self._ready = False
+        self._busy = False
+        self._timer = None
+        self._stats = _UploadStats()
         self.callback = callback
+        self.defer_encoding = defer_encoding
+        # Errors of items discarded when encoding was deferred, they are
+        # raised by the next flush() or blocking close() call
+        self.errors = deque()
 
     def write(self, item):
         assert not self.closed, 'attempting writes to a closed writer'
-        data = jsonencode(item)
-        if len(data) > self.maxitemsize:
-            truncated_data = data[:self.ERRMSG_DATA_TRUNCATION_LEN] + "..."
+        if self.defer_encoding:
+            # The offset is unknown until encoded, as discarded items shift
+            # the offsets of the items written after them
+            self._enqueue_many([item])
+            return None
+        return self._write_encoded([self._encode(item)])[0]
+
+    def write_many(self, items):
+        """Write items in bulk, returning the range of their offsets
+
+        Items are encoded and enqueued in chunks of the batch size. When an
+        item fails to encode, the items before it are written and the error
+        is raised as write() does. Returns None when encoding is deferred.
+        """
+        assert not self.closed, 'attempting writes to a closed writer'
+        items = iter(items)
+        if self.defer_encoding:
+            for chunk in iter(lambda: list(islice(items, self.size)), []):
+                self._enqueue_many(chunk)
+            return None
+        first = last = None
+        # Items of concurrent calls are not interleaved, so the offsets of
+        # each call are a single range
+        with self._write_lock:
+            for chunk in iter(lambda: list(islice(items, self.size)), []):
+                data = []
+                try:
+                    for item in chunk:
+                        data.append(self._encode(item))
+                except Exception:
+                    if data:
+                        self._write_encoded(data)
+                    raise
+                offsets = self._write_encoded(data)
+                if first is None:
+                    first = offsets[0]
+                last = offsets[-1]
+        return range(0) if first is None else range(first, last + 1)
+
+    def _write_encoded(self, data):
+        # Offsets match the order of the queue with concurrent writes
+        with self._write_lock:
+            self._enqueue_many(data)
+            return list(islice(self._nextid, len(data)))
+
+    def _enqueue_many(self, data, spool=True):
+        blocked = size = 0
+        if not self.defer_encoding:
+            size = sum(_datasize(x) + 1 for x in data)
+            for budget in self.budgets:
+                blocked += budget.acquire(
+                    size, partial(self.uploader._relieve, budget))
+
+        on_full = partial(self.uploader._notify, self)
+        if spool and self.spool is not None:
+            # Keep the spool in the same order as the queue
+            with self.spool.lock:
+                for x in data:
+                    self.spool.append(x)
+                blocked += self.itemsq.put_many(data, on_full)
+        else:
+            blocked += self.itemsq.put_many(data, on_full)
+        if blocked:
+            self.uploader._record(self, blocked_time=blocked)
+        if size:
+            self._add_queued_bytes(size)
+        if self.itemsq.qsize() >= self.size or self.batch_bytes_reached():
+            self.uploader._notify(self)
+        else:
+            self.uploader._arm(self)
+
+    def stats(self):
+        """Return upload metrics of the writer"""
+        stats = self._stats.snapshot()
+        stats.update(
+            queue_depth=self.itemsq.qsize(),
+            queued_bytes=self.queued_bytes,
+            offset=self.offset,
+        )
+        return stats
+
+    def _add_queued_bytes(self, size):
+        with self._bytes_lock:
+            self.queued_bytes += size
+
+    def batch_bytes_reached(self):
+        return bool(self.max_batch_bytes and
+                    self.queued_bytes >= self.max_batch_bytes)
+
+    def wants_checkpoint(self):
+        """Check if the writer has a batch to upload before its interval"""
+        q = self.itemsq
+        return (q.qsize() >= self.size or self.batch_bytes_reached() or
+                self.budget_blocked() or self.prepared is not None or
+                ((self.closed or self.flushme) and not q.empty()))
+
+    def budget_blocked(self):
+        # Upload queued items early when writes are blocked on a byte limit
+        return any(b.waiting for b in self.budgets) and \
+            not self.itemsq.empty()
+
+    def _itersized(self, iterable, size):
+        # Stop consuming the queue once the batch reaches max_batch_bytes,
+        # the last item may make the batch exceed it up to maxitemsize
+        try:
+            for data in iterable:
+                size[0] += _datasize(data) + 1
+                yield data
+                if self.max_batch_bytes and size[0] >= self.max_batch_bytes:
+                    break
+        finally:
+            if not self.defer_encoding:
+                self._add_queued_bytes(-size[0])
+
+    def _encode(self, item):
+        if self.use_msgpack:
+            data = mpencode(item)
+        else:
+            data = self.json_backend.dumps(item)
+        if _datasize(data) > self.maxitemsize:
+            ellipsis = b"..." if self.use_msgpack else "..."
+            truncated_data = data[:self.ERRMSG_DATA_TRUNCATION_LEN] + ellipsis
             raise ValueTooLarge(
                 'Value exceeds max encoded size of {}: {!r}'
                 .format(sizeof_fmt(self.maxitemsize), truncated_data))
+        return data
 
-        self.itemsq.put(data)
-        if self.itemsq.full():
-            self.uploader.interrupt()
-        return next(self._nextid)
+    def _iterencode(self, iterable, errors):
+        for item in iterable:
+            try:
+                yield self._encode(item)
+            except ValueTooLarge as exc:
+                logger.warning('Discarding item written to %s: %s',
+                               self.url, exc)
+                errors.append(exc)
+
+    def _raise_deferred_error(self):
+        try:
+            exc = self.errors.popleft()
+        except IndexError:
+            return
+        raise exc
 
     def flush(self):
         self.flushme = True
         self._waitforq()
         self.flushme = False
+        self._raise_deferred_error()
 
     def close(self, block=True):
         self.closed = True
+        self.uploader._notify(self)
         if block:
             self._waitforq()
+            self._raise_deferred_error()
 
     def _waitforq(self):
-        self.uploader.interrupt()
+        self.uploader._notify(self)
         self.itemsq.join()
 
     def __str__(self):
         return self.url
 
 
-def _encode_identity(iterable):
-    data = BytesIO()
+def register_content_encoding(name, encoder):
+    """Register an encoder for batch uploads using a content encoding
+
+    The encoder is called with an iterable of serialized items (JSON text
+    lines or msgpack bytes) and the compression level of the writer (None
+    for the default level), and must return the request body, bytes or a
+    :class:`BatchBody`.
+    """
+    CONTENT_ENCODERS[name] = encoder
+
+
+class BatchBody(object):
+    """Request body of a batch upload made of chunks of bytes
+
+    The chunks are streamed to the server without joining them in a single
+    buffer, and the body can be sent again when the upload is retried.
+    """
+
+    #: Size of the chunks of the body
+    chunk_size = 64 * 1024
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.size = sum(len(chunk) for chunk in self.chunks)
+
+    @classmethod
+    def from_iterable(cls, iterable):
+        """Build a body coalescing small pieces of data into chunks"""
+        return cls(_coalesce(iterable, cls.chunk_size))
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return self.size
+
+
+def _datasize(data):
+    """Return the size of serialized data once encoded to UTF-8"""
+    # JSON backends like orjson don't escape non ASCII characters
+    if isinstance(data, six.text_type) and not data.isascii():
+        return len(data.encode('utf8'))
+    return len(data)
+
+
+def _coalesce(iterable, size):
+    buf, buflen = [], 0
+    for data in iterable:
+        buf.append(data)
+        buflen += len(data)
+        if buflen >= size:
+            yield b''.join(buf)
+            buf, buflen = [], 0
+    if buflen:
+        yield b''.join(buf)
+
+
+def _itercollect(iterable, collected):
+    for data in iterable:
+        collected.append(data)
+        yield data
+
+
+def _iterlines(iterable):
+    # JSON items are text ended by newlines, msgpack items are bytes which
+    # need no separator
     for item in iterable:
         if isinstance(item, six.text_type):
-            item = item.encode('utf8')
-        data.write(item)
-        data.write(b'\n')
-    return data.getvalue()
+            yield item.encode('utf8')
+            yield b'\n'
+        else:
+            yield item
 
 
-def _encode_gzip(iterable):
-    data = BytesIO()
-    with GzipFile(fileobj=data, mode='w') as gzo:
-        for item in iterable:
-            if isinstance(item, six.text_type):
-                item = item.encode('utf8')
-            gzo.write(item)
-            gzo.write(b'\n')
-    return data.getvalue()
+def _itercompress(iterable, compressor):
+    # Items are compressed by chunks, only the compressed data is kept
+    for chunk in _coalesce(_iterlines(iterable), BatchBody.chunk_size):
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def _encode_identity(iterable, level=None):
+    return BatchBody.from_iterable(_iterlines(iterable))
+
+
+def _encode_gzip(iterable, level=None):
+    compressor = zlib.compressobj(9 if level is None else level, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return BatchBody.from_iterable(_itercompress(iterable, compressor))
+
+
+def _encode_deflate(iterable, level=None):
+    compressor = zlib.compressobj(-1 if level is None else level)
+    return BatchBody.from_iterable(_itercompress(iterable, compressor))
+
+
+def _encode_zstd(iterable, level=None):
+    compressor = zstandard.ZstdCompressor(
+        level=3 if level is None else level).compressobj()
+    return BatchBody.from_iterable(_itercompress(iterable, compressor))
+
+
+CONTENT_ENCODERS = {
+    'identity': _encode_identity,
+    'gzip': _encode_gzip,
+    'deflate': _encode_deflate,
+}
+if ZSTD_AVAILABLE:
+    CONTENT_ENCODERS['zstd'] = _encode_zstd
@@ -11,8 +11,8 @@ from .project import Project
 from .job import Job
 from .jobq import JobQ
 from .batchuploader import BatchUploader
-from .resourcetype import ResourceType
-from .serialization import MSGPACK_AVAILABLE
+from .resourcetype import ResourceType, CHUNK_SIZE
+from .serialization import MSGPACK_AVAILABLE, get_json_backend
 
 
 __all__ = ["HubstorageClient"]
@@ -60,7 +60,9 @@ class HubstorageClient(object):
 
     def __init__(self, auth=None, endpoint=None, connection_timeout=None,
                  max_retries=None, max_retry_time=None, user_agent=None,
-                 use_msgpack=True):
+                 use_msgpack=True, upload_workers=None,
+                 upload_max_queued_bytes=None, upload_spool_dir=None,
+                 upload_msgpack=False, json_backend=None, chunk_size=None):
         """
         Note:
             max_retries and max_retry_time change how the client attempt to retry failing requests that are
@@ -78,6 +80,12 @@ class HubstorageClient(object):
             max_retries (int): The number of time idempotent requests may be retried
             max_retry_time (int): The time, in seconds, during which the client can retry a request
             use_msgpack (bool): Flag to enable/disable msgpack use for serialization
+            upload_workers (int): The number of threads used to upload batches of written data
+            upload_max_queued_bytes (int): The total size of written items buffered for upload before writes block
+            upload_spool_dir (str): A directory where written items are kept until uploaded, to upload them after a crash
+            upload_msgpack (bool): Flag to enable msgpack serialization of written items and collection values
+            json_backend (str): The JSON library used to encode and decode data: 'json' (default), 'orjson', 'ujson', 'simdjson' or 'auto' for the fastest one installed
+            chunk_size (int): The read size of streamed downloads, it can also be set per call with requests_params={'chunk_size': ...}
         """
         self.auth = xauth(auth)
         self.endpoint = endpoint or os.getenv("SHUB_STORAGE", self.DEFAULT_ENDPOINT)
@@ -89,10 +97,19 @@ class HubstorageClient(object):
         self.projects = Projects(self, None)
         self.root = ResourceType(self, None)
         self._batchuploader = None
+        self.upload_workers = upload_workers
+        self.upload_max_queued_bytes = upload_max_queued_bytes
+        self.upload_spool_dir = upload_spool_dir
+        self.json_backend = get_json_backend(json_backend)
+        self.chunk_size = chunk_size or CHUNK_SIZE
         self.use_msgpack = MSGPACK_AVAILABLE and use_msgpack
         if use_msgpack != self.use_msgpack:
             logger.warning('Messagepack is not available, please ensure that '
                            'msgpack library is properly installed.')
+        self.upload_msgpack = MSGPACK_AVAILABLE and upload_msgpack
+        if upload_msgpack != self.upload_msgpack:
+            logger.warning('Messagepack is not available, uploading JSON '
+                           'instead.')
 
     def request(self, is_idempotent=False, **kwargs):
         """
@@ -158,7 +175,10 @@ class HubstorageClient(object):
     @property
     def batchuploader(self):
         if self._batchuploader is None:
-            self._batchuploader = BatchUploader(self)
+            self._batchuploader = BatchUploader(
+                self, workers=self.upload_workers,
+                max_queued_bytes=self.upload_max_queued_bytes,
+                spool_dir=self.upload_spool_dir)
         return self._batchuploader
 
     def get_job(self, *args, **kwargs):
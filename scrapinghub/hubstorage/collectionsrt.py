@@ -52,6 +52,9 @@ class Collections(DownloadableResource):
 
     def set(self, _type, _name, _values):
         try:
+            if self.client.upload_msgpack:
+                return self.apipost((_type, _name), is_idempotent=True,
+                                    mp=_values)
             return self.apipost((_type, _name), is_idempotent=True, jl=_values)
         except HTTPError as exc:
             if exc.response.status_code in (400, 413):
@@ -70,6 +73,12 @@ class Collections(DownloadableResource):
             self, (_type, _name), requests_params=requests_params, **apiparams
         )
 
+    def _iter_json_bytes(self, _type, _name, requests_params=None,
+                         **apiparams):
+        return DownloadableResource._iter_json_bytes(
+            self, (_type, _name), requests_params=requests_params, **apiparams
+        )
+
     def iter_msgpack(self, _type, _name, requests_params=None, **apiparams):
         return DownloadableResource.iter_msgpack(
             self, (_type, _name), requests_params=requests_params, **apiparams
@@ -173,3 +182,9 @@ class Collection(object):
         return self._collections.iter_values(
             self.coltype, self.colname, requests_params=requests_params, **apiparams
         )
+
+    def _iter_msgpack_values(self, _type, _name, requests_params=None,
+                             **apiparams):
+        return DownloadableResource._iter_msgpack_values(
+            self, (_type, _name), requests_params=requests_params, **apiparams
+        )
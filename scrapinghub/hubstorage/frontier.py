@@ -13,6 +13,7 @@ class Frontier(ResourceType):
     batch_interval = 60.0
     batch_append = False
     batch_content_encoding = 'identity'
+    batch_compression_level = None
 
     def __init__(self, *a, **kw):
         self._writers = {}  # dict of writers indexed by (frontier, slot)
@@ -31,6 +32,7 @@ class Frontier(ResourceType):
                 interval=self.batch_interval,
                 qsize=self.batch_qsize,
                 content_encoding=self.batch_content_encoding,
+                compression_level=self.batch_compression_level,
                 callback=self._writer_callback
             )
             self._writers[key] = writer
@@ -8,11 +8,12 @@ import requests.exceptions as rexc
 from six.moves import range, collections_abc
 
 from .utils import urlpathjoin, xauth
-from .serialization import jlencode, jldecode, mpdecode
+from .serialization import jlencode, jldecode, mpdecode, mplencode
 
 
 logger = logging.getLogger('hubstorage.resourcetype')
-CHUNK_SIZE = 512
+# Default read size of downloads, see HubstorageClient.chunk_size
+CHUNK_SIZE = 64 * 1024
 STATS_CHUNK_SIZE = 512 * 1024
 
 
@@ -54,29 +55,33 @@ class ResourceType(object):
     def _iter_content(self, _path, **kwargs):
         kwargs['url'] = urlpathjoin(self.url, _path)
         kwargs.setdefault('auth', self.auth)
-        return self.client.request(**kwargs).iter_content(CHUNK_SIZE)
+        chunk_size = kwargs.pop('chunk_size', self.client.chunk_size)
+        return self.client.request(**kwargs).iter_content(chunk_size)
 
     def _iter_lines(self, _path, **kwargs):
+        """Iterate over the lines of the response as bytes"""
         kwargs['url'] = urlpathjoin(self.url, _path)
         kwargs.setdefault('auth', self.auth)
-        chunk_size = kwargs.pop('chunk_size', CHUNK_SIZE)
+        chunk_size = kwargs.pop('chunk_size', self.client.chunk_size)
         if 'jl' in kwargs:
             # XXX explicitly encode data to overcome shazow/urllib3#717
             # when dealing with large POST requests with enabled TLS
-            kwargs['data'] = jlencode(kwargs.pop('jl')).encode('utf-8')
+            kwargs['data'] = jlencode(
+                kwargs.pop('jl'), self.client.json_backend).encode('utf-8')
+        elif 'mp' in kwargs:
+            kwargs['data'] = mplencode(kwargs.pop('mp'))
+            kwargs.setdefault('headers', {})
+            kwargs['headers']['Content-Type'] = 'application/x-msgpack'
 
         r = self.client.request(**kwargs)
-
-        lines = r.iter_lines(chunk_size=chunk_size)
-        if six.PY3:
-            return (l.decode(r.encoding or 'utf8') for l in lines)
-        return lines
+        return _split_lines(r.iter_content(chunk_size))
 
     def apirequest(self, _path=None, **kwargs):
         if self._allows_mpack(_path) and kwargs.get('method').upper() == 'GET':
             kwargs = self._enforce_msgpack(**kwargs)
             return mpdecode(self._iter_content(_path=_path, **kwargs))
-        return jldecode(self._iter_lines(_path, **kwargs))
+        return jldecode(self._iter_lines(_path, **kwargs),
+                        self.client.json_backend)
 
     def apipost(self, _path=None, **kwargs):
         return self.apirequest(_path, method='POST', **kwargs)
@@ -107,31 +112,54 @@ class DownloadableResource(ResourceType):
     def _add_resume_param(self, lastline, offset, params):
         """Adds a startafter=LASTKEY parameter if there was a lastvalue"""
         if lastline is not None:
-            lastvalue = json.loads(lastline)
+            if isinstance(lastline, dict):
+                lastvalue = lastline
+            else:
+                lastvalue = json.loads(lastline)
             params['startafter'] = lastvalue['_key']
             if 'start' in params:
                 del params['start']
 
+    def _resume_offset(self, _path, params):
+        """Return the offset of the first value returned for params
+
+        Reads are resumed from that offset plus the number of values read
+        instead of the key of the last value, if it's not None.
+        """
+        return None
+
     def iter_values(self, *args, **kwargs):
         """Reliably iterate through all data as python objects
 
         calls either iter_json or iter_msgpack, decoding the results
         """
         if self._allows_mpack():
-            return mpdecode(self.iter_msgpack(*args, **kwargs))
-        return jldecode(self.iter_json(*args, **kwargs))
+            return self._iter_msgpack_values(*args, **kwargs)
+        return jldecode(self._iter_json_bytes(*args, **kwargs),
+                        self.client.json_backend)
 
     def _retry(self, iter_callback, resume=False, _path=None, requests_params=None, **apiparams):
         """Reliable iterate through all data calling iter_callback"""
+        start = self._resume_offset(_path, apiparams) if resume else None
         self._add_key_meta(apiparams)
+        count = apiparams.get('count')
+        params = apiparams
         lastexc = None
         chunk = None
         offset = 0
         for attempt in range(self.MAX_RETRIES):
-            if resume:
-                self._add_resume_param(chunk, offset, apiparams)
+            if resume and offset:
+                params = dict(apiparams)
+                if start is None:
+                    self._add_resume_param(chunk, offset, params)
+                else:
+                    params['start'] = urlpathjoin(self._jobkey, start + offset)
+                if count is not None:
+                    params['count'] = int(count) - offset
+                    if params['count'] <= 0:
+                        break
             try:
-                for chunk in iter_callback(_path=_path, params=apiparams,
+                for chunk in iter_callback(_path=_path, params=params,
                                            **requests_params):
                     yield chunk
                     offset += 1
@@ -163,15 +191,57 @@ class DownloadableResource(ResourceType):
                                  requests_params, **apiparams):
             yield chunk
 
+    def _iter_msgpack_values(self, _path=None, requests_params=None,
+                             **apiparams):
+        """Reliably iterate through all data decoded from msgpack"""
+        requests_params = dict(requests_params or {})
+        requests_params.setdefault('method', 'GET')
+        requests_params.setdefault('stream', True)
+        requests_params.setdefault('is_idempotent', True)
+        requests_params = self._enforce_msgpack(**requests_params)
+        return self._retry(self._iter_mpdecode, True, _path, requests_params,
+                           **apiparams)
+
+    def _iter_mpdecode(self, _path, **kwargs):
+        return mpdecode(self._iter_content(_path, **kwargs))
+
     def iter_json(self, _path=None, requests_params=None, **apiparams):
         """Reliably iterate through all data as json strings"""
+        # Not dispatched to subclasses, which override _iter_json_bytes
+        # with their own path arguments for iter_values
+        lines = DownloadableResource._iter_json_bytes(
+            self, _path, requests_params, **apiparams)
+        for line in lines:
+            yield line.decode('utf8')
+
+    def _iter_json_bytes(self, _path=None, requests_params=None, **apiparams):
+        """Reliably iterate through all data as json lines in bytes"""
         requests_params = dict(requests_params or {})
         requests_params.setdefault('method', 'GET')
         requests_params.setdefault('stream', True)
         requests_params.setdefault('is_idempotent', True)
-        for line in self._retry(self._iter_lines, True, _path, requests_params,
-                                **apiparams):
-            yield line
+        return self._retry(self._iter_lines, True, _path, requests_params,
+                           **apiparams)
+
+
+def _split_lines(chunks):
+    """Split chunks of bytes in lines, skipping empty lines"""
+    pending = []
+    for chunk in chunks:
+        if b'\n' not in chunk:
+            pending.append(chunk)
+            continue
+        lines = chunk.split(b'\n')
+        if pending:
+            pending.append(lines[0])
+            lines[0] = b''.join(pending)
+        pending = [lines.pop()]
+        for line in lines:
+            if line:
+                yield line
+    line = b''.join(pending)
+    if line:
+        yield line
 
 
 class ItemsResourceType(ResourceType):
@@ -181,12 +251,16 @@ class ItemsResourceType(ResourceType):
     batch_start = 0
     batch_interval = 15.0
     batch_content_encoding = 'identity'
+    batch_compression_level = None
+    batch_defer_encoding = False
+    batch_max_bytes = None
+    batch_adaptive = False
 
     # batch writer reference in case of used
     _writer = None
 
-    # TODO override _add_resume_param - can avoid requestomg _key by
-    # deriving from project, spider, job and offset
+    # Params for which values are read in offset order, see _resume_offset
+    offset_resume_params = frozenset(['start', 'count', 'meta'])
 
     def batch_write_start(self):
         """Override to set a start parameter when commencing writing"""
@@ -202,7 +276,12 @@ class ItemsResourceType(ResourceType):
                 start=self.batch_write_start(),
                 interval=self.batch_interval,
                 qsize=self.batch_qsize,
-                content_encoding=self.batch_content_encoding
+                content_encoding=self.batch_content_encoding,
+                compression_level=self.batch_compression_level,
+                defer_encoding=self.batch_defer_encoding,
+                max_batch_bytes=self.batch_max_bytes,
+                adaptive=self.batch_adaptive,
+                use_msgpack=self.client.upload_msgpack,
             )
         return self._writer
 
@@ -217,9 +296,30 @@ class ItemsResourceType(ResourceType):
     def write(self, item):
         return self.writer.write(item)
 
+    def write_many(self, items):
+        return self.writer.write_many(items)
+
     def list(self, _key=None, **params):
         return self.apiget(_key, params=params)
 
+    @property
+    def _jobkey(self):
+        return self.key.split('/', 1)[1]
+
+    def _resume_offset(self, _path, params):
+        """Derive keys of values read from the job key and their offset
+
+        It's only possible when values are read without filters.
+        """
+        if _path or not self.offset_resume_params.issuperset(params):
+            return None
+        start = params.get('start')
+        if start is None:
+            return 0
+        prefix, _, offset = str(start).rpartition('/')
+        if prefix == self._jobkey and offset.isdigit():
+            return int(offset)
+
     def get(self, _key, **params):
         """Return first matching result"""
         for o in self.list(_key, params=params):
@@ -1,3 +1,4 @@
+from collections import namedtuple
 from datetime import datetime
 from json import dumps, loads
 
@@ -8,22 +9,45 @@ ADAYINSECONDS = 24 * 3600
 
 
 try:
-    from msgpack import Unpacker
+    from msgpack import Packer, Unpacker, packb
 
     MSGPACK_AVAILABLE = True
 except ImportError:
     MSGPACK_AVAILABLE = False
 
+try:
+    import orjson
+
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import ujson
+
+    UJSON_AVAILABLE = True
+except ImportError:
+    UJSON_AVAILABLE = False
 
-def jlencode(iterable):
+try:
+    import simdjson
+
+    SIMDJSON_AVAILABLE = True
+except ImportError:
+    SIMDJSON_AVAILABLE = False
+
+
+def jlencode(iterable, backend=None):
     if isinstance(iterable, (dict, six.string_types)):
         iterable = [iterable]
-    return u'\n'.join(jsonencode(o) for o in iterable)
+    encode = jsonencode if backend is None else backend.dumps
+    return u'\n'.join(encode(o) for o in iterable)
 
 
-def jldecode(lineiterable):
+def jldecode(lineiterable, backend=None):
+    decode = loads if backend is None else backend.loads
     for line in lineiterable:
-        yield loads(line)
+        yield decode(line)
 
 
 def mpdecode(iterable):
@@ -36,6 +60,17 @@ def mpdecode(iterable):
             yield obj
 
 
+def mpencode(o):
+    return packb(o, default=jsondefault)
+
+
+def mplencode(iterable):
+    if isinstance(iterable, (dict, six.string_types)):
+        iterable = [iterable]
+    packer = Packer(default=jsondefault)
+    return b''.join(packer.pack(o) for o in iterable)
+
+
 def jsonencode(o):
     return dumps(o, default=jsondefault)
 
@@ -52,3 +87,56 @@ def jsondefault(o):
         return (u + (s + d * ADAYINSECONDS) * 1e6) // 1000
     else:
         return six.text_type(o)
+
+
+#: A JSON library, dumps returns text and converts values as jsondefault does
+JSONBackend = namedtuple('JSONBackend', 'name dumps loads')
+
+
+def _orjson_dumps(o):
+    try:
+        return orjson.dumps(o, default=jsondefault,
+                            option=_ORJSON_OPTIONS).decode('utf8')
+    except TypeError:
+        # Values orjson refuses, like integers over 64 bits
+        return jsonencode(o)
+
+
+def _ujson_dumps(o):
+    try:
+        return ujson.dumps(o, default=jsondefault,
+                           escape_forward_slashes=False)
+    except (TypeError, OverflowError):
+        return jsonencode(o)
+
+
+JSON_BACKENDS = {'json': JSONBackend('json', jsonencode, loads)}
+if ORJSON_AVAILABLE:
+    # Datetimes go through jsondefault, keys are converted as json does
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    JSON_BACKENDS['orjson'] = JSONBackend('orjson', _orjson_dumps,
+                                          orjson.loads)
+if UJSON_AVAILABLE:
+    JSON_BACKENDS['ujson'] = JSONBackend('ujson', _ujson_dumps, ujson.loads)
+if SIMDJSON_AVAILABLE:
+    # simdjson only parses
+    JSON_BACKENDS['simdjson'] = JSONBackend('simdjson', jsonencode,
+                                            simdjson.loads)
+
+
+def get_json_backend(name=None):
+    """Return the JSON backend with the given name
+
+    None is the standard library json module, and 'auto' is the fastest
+    backend installed.
+    """
+    if name is None:
+        return JSON_BACKENDS['json']
+    if name == 'auto':
+        for name in ('orjson', 'ujson', 'simdjson', 'json'):
+            if name in JSON_BACKENDS:
+                return JSON_BACKENDS[name]
+    try:
+        return JSON_BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown or unavailable JSON backend: %s' % name)
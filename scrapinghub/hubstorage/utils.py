@@ -107,10 +107,12 @@ class iterqueue(object):
     def __iter__(self):
         while (self.maxcount is None) or (self.count < self.maxcount):
             try:
-                yield self.queue.get_nowait()
-                self.count += 1
+                item = self.queue.get_nowait()
             except Empty:
                 break
+            # count before yielding, consumers may stop iterating any time
+            self.count += 1
+            yield item
 
 
 def apipoll(endpoint, *args, **kwargs):
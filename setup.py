@@ -28,7 +28,8 @@ setup(
     package_data={'scrapinghub': ['VERSION']},
     install_requires=['python-dotenv>=1.0.0', 'requests>=1.0',
                       'retrying>=1.3.3', 'six>=1.10.0'],
-    extras_require={'msgpack': mpack_required},
+    extras_require={'msgpack': mpack_required, 'zstd': ['zstandard'],
+                    'orjson': ['orjson'], 'ujson': ['ujson']},
     python_requires='>=3.10',
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -1,6 +1,11 @@
+import time
+
+import mock
 import pytest
 from six.moves import range
 
+from scrapinghub.client.items import Items
+
 from .utils import normalize_job_for_tests
 
 
@@ -103,3 +108,58 @@ def test_items_list_iter_with_start_and_count_2(spider, json_and_msgpack):
     ]
     with pytest.raises(StopIteration):
         next(o)
+
+
+def _parallel_items(total):
+    client = mock.Mock(_hsclient=object())
+    items = Items(mock.Mock, client, '1/2/3')
+    items.stats = lambda: {'totals': {'input_values': total}}
+    requested = []
+
+    def iter(count, start, **params):
+        offset = int(start.rsplit('/', 1)[1])
+        requested.append((offset, count))
+        # later ranges are fetched faster
+        time.sleep(0.001 * (total - offset) / total)
+        return iter_items(offset, count)
+
+    def iter_items(offset, count):
+        for i in range(offset, min(offset + count, total)):
+            yield {'id': i}
+
+    items.iter = iter
+    return items, requested
+
+
+def test_items_iter_parallel():
+    items, requested = _parallel_items(95)
+    result = list(items.iter_parallel(workers=3, chunksize=10))
+    assert result == [{'id': i} for i in range(95)]
+    assert sorted(requested) == [(x, 10 if x < 90 else 5)
+                                 for x in range(0, 95, 10)]
+
+    items, requested = _parallel_items(95)
+    result = list(items.iter_parallel(workers=3, chunksize=10, ordered=False,
+                                      start=5, count=50))
+    assert sorted(x['id'] for x in result) == list(range(5, 55))
+
+    items, _ = _parallel_items(0)
+    assert list(items.iter_parallel()) == []
+
+    # stopping early doesn't wait for the running fetches
+    items, requested = _parallel_items(95)
+    slow = items.iter
+
+    def iter(count, start, **params):
+        if start != '1/2/3/0':
+            time.sleep(1)
+        return slow(count, start, **params)
+
+    items.iter = iter
+    result = items.iter_parallel(workers=3, chunksize=10)
+    started = time.time()
+    assert next(result) == {'id': 0}
+    result.close()
+    assert time.time() - started < 0.5
+    with pytest.raises(ValueError):
+        list(items.iter_parallel(filter=[('id', '>', [1])]))
@@ -1,6 +1,7 @@
 import types
 from collections import defaultdict
 
+import mock
 import pytest
 import responses
 from requests.compat import urljoin
@@ -292,3 +293,38 @@ def test_settings_iter_list(project):
     settings_list = project.settings.list()
     assert ('job_runtime_limit', 24) in settings_list
     assert settings_list == list(settings_iter)
+
+
+def test_project_jobs_iter_items():
+    client = ScrapinghubClient('apikey')
+    jobs = client.get_project(1).jobs
+    keys = ['1/2/%d' % i for i in range(1, 21)]
+    jobs.iter = lambda **params: iter([{'key': key} for key in keys])
+
+    def get(key):
+        job = mock.Mock(key=key)
+        n = int(key.rsplit('/', 1)[1])
+        job.items.iter = lambda **params: iter(
+            [{'n': i, 'params': params} for i in range(n)])
+        return job
+
+    jobs.get = get
+    results = defaultdict(list)
+    for key, item in jobs.iter_items(workers=4, buffer_size=5,
+                                     items_params={'meta': ['_key']}):
+        results[key].append(item['n'])
+        assert item['params'] == {'meta': ['_key']}
+    assert results == {key: list(range(int(key.rsplit('/', 1)[1])))
+                       for key in keys}
+
+    # explicit keys, and stopping early
+    items = jobs.iter_items(keys=keys[-2:], workers=2, buffer_size=1)
+    assert next(items)[0] in keys[-2:]
+    items.close()
+
+    def failing(key):
+        raise ValueError(key)
+
+    jobs.get = failing
+    with pytest.raises(ValueError):
+        list(jobs.iter_items(workers=2))
@@ -3,6 +3,8 @@ import pytest
 
 from scrapinghub.client.proxy import _format_iter_filters
 from scrapinghub.client.proxy import _ItemsResourceProxy
+from scrapinghub.client.exceptions import ValueTooLarge
+from scrapinghub.hubstorage import ValueTooLarge as _ValueTooLarge
 
 
 def test_format_iter_filters():
@@ -61,3 +63,17 @@ def test_item_resource_iter_with_params():
     items_proxy.iter(count=123, startts=12345)
     assert (items_proxy._origin.list.call_args ==
             mock.call(None, count=123, startts=12345))
+
+
+def test_item_resource_write_many():
+    class MockClient:
+        def __init__(self):
+            self._hsclient = object()
+
+    items_proxy = _ItemsResourceProxy(mock.Mock, MockClient(), 'mocked_key')
+    items_proxy._origin = mock.Mock()
+    items_proxy._origin.write_many.return_value = range(3)
+    assert items_proxy.write_many([{'a': 1}] * 3) == range(3)
+    items_proxy._origin.write_many.side_effect = _ValueTooLarge('too large')
+    with pytest.raises(ValueTooLarge):
+        items_proxy.write_many([{'a': 1}])
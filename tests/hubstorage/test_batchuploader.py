@@ -1,15 +1,30 @@
 """
 Test Project
 """
+import os
+import re
 import time
+import hashlib
+import zlib
+import threading
 import pytest
+import responses
 from six.moves import range
 from collections import defaultdict
+from datetime import datetime
 
+from scrapinghub import HubstorageClient
 from scrapinghub.hubstorage import ValueTooLarge
-from ..conftest import TEST_SPIDER_NAME, TEST_AUTH
+from scrapinghub.hubstorage.batchuploader import ZSTD_AVAILABLE, BatchBody
+from scrapinghub.hubstorage.batchuploader import CONTENT_ENCODERS, _Spool
+from scrapinghub.hubstorage.serialization import (
+    MSGPACK_AVAILABLE, ORJSON_AVAILABLE, jsondefault, mpdecode)
+from ..conftest import TEST_SPIDER_NAME, TEST_AUTH, TEST_ENDPOINT
 from .conftest import start_job
 
+if ZSTD_AVAILABLE:
+    import zstandard
+
 
 def _job_and_writer(hsclient, hsproject, **writerargs):
     hsproject.push_job(TEST_SPIDER_NAME)
@@ -90,3 +105,606 @@ def test_writer_interval(hsclient, hsproject, json_and_msgpack):
         groups[doc['_ts']] += 1
 
     assert len(groups) == 2
+
+
+def _read_body(request):
+    body = request.body
+    return body if isinstance(body, bytes) else b''.join(body)
+
+
+def _mock_upload(url_match, callback=None, status=200, body='{}'):
+    if callback is None:
+        def callback(request):
+            return status, {}, body
+    responses.add_callback(
+        responses.POST, re.compile(TEST_ENDPOINT + url_match),
+        callback=callback, content_type='application/json')
+
+
+@responses.activate
+def test_writer_workers_pool():
+    blocked = threading.Event()
+    release = threading.Event()
+    offsets = []
+
+    def slow_upload(request):
+        blocked.set()
+        release.wait(10)
+        return 200, {}, '{}'
+
+    def fast_upload(request):
+        offsets.append(int(request.params['start']))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', slow_upload)
+    _mock_upload('/items/1/2/4', fast_upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT,
+                              upload_workers=2)
+    uploader = client.batchuploader
+    slow = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/3', size=1)
+    fast = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/4', size=2)
+    try:
+        slow.write({'x': 0})
+        assert blocked.wait(10)
+        for x in range(10):
+            fast.write({'x': x})
+        fast.flush()
+        assert offsets == [0, 2, 4, 6, 8]
+    finally:
+        release.set()
+        client.close()
+    assert len(uploader._threads) == 2
+
+
+@responses.activate
+def test_writer_retry_does_not_block_other_writers(monkeypatch):
+    healthy_done = threading.Event()
+    attempts = []
+
+    def failing_upload(request):
+        attempts.append((int(request.params['start']), _read_body(request)))
+        if not healthy_done.is_set():
+            return 503, {}, 'Service Unavailable'
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', failing_upload)
+    _mock_upload('/items/1/2/4')
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    uploader = client.batchuploader
+    monkeypatch.setattr(uploader, 'worker_min_interval', 0.01)
+    monkeypatch.setattr(uploader, 'worker_max_interval', 0.05)
+    failing = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/3', size=1)
+    healthy = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/4')
+    try:
+        failing.write({'x': 0})
+        while not attempts:
+            time.sleep(0.01)
+        healthy.write({'x': 0})
+        healthy.flush()
+        assert healthy.offset == 1
+        healthy_done.set()
+        failing.flush()
+        assert failing.offset == 1
+        assert len(attempts) > 1
+        assert set(attempts) == {(0, b'{"x": 0}\n')}
+    finally:
+        client.close()
+
+
+@responses.activate
+def test_writer_encodes_next_batch_during_upload():
+    uploads = []
+
+    def upload(request):
+        prepared = writer.prepared
+        if prepared is not None:
+            prepared = prepared.result(10)['offset']
+        uploads.append((int(request.params['start']), prepared))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', size=2, qsize=10,
+        content_encoding='gzip')
+    try:
+        for x in range(6):
+            writer.write({'x': x})
+        writer.flush()
+    finally:
+        client.close()
+    assert [start for start, _ in uploads] == [0, 2, 4]
+    assert (0, 2) in uploads or (2, 4) in uploads
+
+
+@responses.activate
+def test_writer_defer_encoding():
+    uploaded = []
+
+    def upload(request):
+        start = int(request.params['start'])
+        lines = _read_body(request).splitlines()
+        uploaded.extend((start + i, line) for i, line in enumerate(lines))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', maxitemsize=100, defer_encoding=True)
+    try:
+        # offsets are unknown until items are encoded
+        assert writer.write({'x': 0}) is None
+        writer.write({'b': 'x' * 100})
+        # errors are raised by flush, items written meanwhile are kept
+        assert writer.write_many([{'x': 1}]) is None
+        with pytest.raises(ValueTooLarge) as excinfo:
+            writer.flush()
+        excinfo.match('Value exceeds max encoded size of 100 B')
+        writer.write({'x': 2})
+        writer.flush()
+    finally:
+        client.close()
+    assert uploaded == [(x, b'{"x": %d}' % x) for x in range(3)]
+
+
+@responses.activate
+def test_writer_max_batch_bytes():
+    batches = []
+
+    def upload(request):
+        lines = _read_body(request).splitlines()
+        batches.append((int(request.params['start']), len(lines)))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', size=1000, qsize=100,
+        max_batch_bytes=100)
+    try:
+        for x in range(20):
+            writer.write({'x': 'y' * 10})  # 20 bytes per line
+        assert writer.queued_bytes <= 20 * 20
+        writer.flush()
+    finally:
+        client.close()
+    assert batches == [(0, 5), (5, 5), (10, 5), (15, 5)]
+    assert writer.queued_bytes == 0
+
+
+@responses.activate
+def test_writer_max_queued_bytes():
+    used = []
+
+    def upload(request):
+        used.append(uploader.budget.used)
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/.*', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT,
+                              upload_max_queued_bytes=100)
+    uploader = client.batchuploader
+    writers = [
+        uploader.create_writer(TEST_ENDPOINT + '/items/1/2/3', interval=1000),
+        uploader.create_writer(TEST_ENDPOINT + '/items/1/2/4', interval=1000,
+                               max_queue_bytes=40),
+    ]
+    try:
+        for x in range(20):
+            writers[x % 2].write({'x': 'y' * 10})  # 20 bytes per line
+        assert uploader.budget.used <= 100
+        assert writers[1].budgets[0].used <= 40
+        for writer in writers:
+            writer.flush()
+    finally:
+        client.close()
+    assert used and max(used) <= 100
+    assert uploader.budget.used == 0
+    assert sum(w.offset for w in writers) == 20
+
+
+@pytest.mark.parametrize('content_encoding, level, decompress', [
+    ('gzip', 1, lambda body: zlib.decompress(body, 16 + zlib.MAX_WBITS)),
+    ('deflate', None, zlib.decompress),
+    ('deflate', 1, zlib.decompress),
+    ('zstd', 1, lambda body: (
+        zstandard.ZstdDecompressor().decompressobj().decompress(body))),
+])
+@responses.activate
+def test_writer_compression(content_encoding, level, decompress):
+    if content_encoding == 'zstd' and not ZSTD_AVAILABLE:
+        pytest.skip('zstandard is not installed')
+    bodies = []
+
+    def upload(request):
+        bodies.append((request.headers['content-encoding'],
+                       _read_body(request)))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', content_encoding=content_encoding,
+        compression_level=level)
+    try:
+        for x in range(3):
+            writer.write({'x': x})
+        writer.flush()
+    finally:
+        client.close()
+    [(header, body)] = bodies
+    assert header == content_encoding
+    assert decompress(body) == b'{"x": 0}\n{"x": 1}\n{"x": 2}\n'
+
+
+def test_writer_unknown_content_encoding(hsclient):
+    with pytest.raises(ValueError):
+        hsclient.batchuploader.create_writer(
+            TEST_ENDPOINT + '/items/1/2/3', content_encoding='br')
+
+
+@pytest.mark.parametrize('content_encoding', ['identity', 'gzip'])
+def test_batch_body_chunks(monkeypatch, content_encoding):
+    monkeypatch.setattr(BatchBody, 'chunk_size', 1024)
+    items = [hashlib.sha1(str(x).encode()).hexdigest() * 3
+             for x in range(1000)]
+    body = CONTENT_ENCODERS[content_encoding](items)
+    assert len(body.chunks) > 1
+    assert all(len(chunk) >= 1024 for chunk in body.chunks[:-1])
+    data = b''.join(body)
+    assert len(body) == len(data)
+    # bodies can be iterated again to retry uploads
+    assert b''.join(body) == data
+    if content_encoding == 'gzip':
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    assert data == b''.join(x.encode() + b'\n' for x in items)
+
+
+@responses.activate
+def test_writer_spool_replay(tmp_path):
+    url = TEST_ENDPOINT + '/items/1/2/3'
+    bodies = []
+
+    def upload(request):
+        bodies.append((int(request.params['start']), _read_body(request)))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    # items left behind by a process that died after uploading 2 of them
+    spool = _Spool(str(tmp_path), url, 0)
+    for x in range(5):
+        spool.append('{"x": %d}' % x)
+    spool.ack(2)
+    spool._file.close()
+
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT,
+                              upload_spool_dir=str(tmp_path))
+    writer = client.batchuploader.create_writer(url)
+    try:
+        assert writer.write({'x': 5}) == 5
+        writer.flush()
+        assert sorted(os.listdir(str(tmp_path))) == [
+            os.path.basename(spool.ackpath), os.path.basename(spool.path)]
+        with open(spool.ackpath) as f:
+            assert f.read() == '6'
+        writer.close()
+    finally:
+        client.close()
+    assert bodies == [(2, b'{"x": 2}\n{"x": 3}\n{"x": 4}\n{"x": 5}\n')]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_spool_interrupted_write(tmp_path):
+    url = TEST_ENDPOINT + '/items/1/2/3'
+    spool = _Spool(str(tmp_path), url, 0)
+    spool.append('{"a": 1}')
+    spool._file.write(b'{"a": 2')
+    spool._file.close()
+    spool = _Spool(str(tmp_path), url, 0)
+    assert spool.replay() == ['{"a": 1}']
+    spool.append('{"a": 3}')
+    spool._file.close()
+    spool = _Spool(str(tmp_path), url, 0)
+    assert spool.replay() == ['{"a": 1}', '{"a": 3}']
+    assert spool.end == 2
+
+
+@responses.activate
+def test_writer_stats(monkeypatch):
+    attempts = []
+
+    def upload(request):
+        attempts.append(request)
+        if len(attempts) == 1:
+            return 503, {}, 'Service Unavailable'
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    events = []
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    uploader = client.batchuploader
+    uploader.stats_callback = events.append
+    monkeypatch.setattr(uploader, 'worker_min_interval', 0.01)
+    writer = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/3',
+                                    content_encoding='gzip')
+    try:
+        for x in range(10):
+            writer.write({'x': x})
+        stats = writer.stats()
+        assert stats['queue_depth'] == 10
+        assert stats['queued_bytes'] == 90
+        writer.flush()
+        stats = writer.stats()
+    finally:
+        client.close()
+    assert stats['queue_depth'] == 0
+    assert stats['queued_bytes'] == 0
+    assert stats['batches'] == 1
+    assert stats['items'] == 10
+    assert stats['raw_bytes'] == 90
+    assert 0 < stats['sent_bytes'] < 90
+    assert stats['uploads'] == 2
+    assert sum(n for _, n in stats['latency']) == 2
+    assert stats['retries'] == 1
+    assert stats['failed_batches'] == 0
+    assert 'HTTP error 503' in stats['last_error']['error']
+    assert uploader.stats()['items'] == 10
+    [event] = events
+    assert event['count'] == 10
+    assert event['retries'] == 1
+    assert event['status'] == 200
+
+
+@responses.activate
+def test_writer_scheduling():
+    uploaded = []
+    _mock_upload('/items/1/2/.*', lambda request: (
+        uploaded.append(request.url) or (200, {}, '{}')))
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    uploader = client.batchuploader
+    idle = [uploader.create_writer(TEST_ENDPOINT + '/items/1/2/%d' % x)
+            for x in range(100)]
+    flushed = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/100')
+    timed = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/101',
+                                   interval=0.1)
+    try:
+        # idle writers are not polled
+        assert not uploader._ready and not uploader._timers
+        started = time.time()
+        flushed.write({'x': 0})
+        flushed.flush()
+        assert time.time() - started < 0.5
+        timed.write({'x': 0})
+        # the flushed writer timer was cancelled when it got ready
+        assert [w for _, timer, w in uploader._timers
+                if w._timer == timer] == [timed]
+        timed.itemsq.join()
+        assert time.time() - started < 1
+    finally:
+        client.close()
+    assert len(uploaded) == 2
+    assert all(w not in uploader._live_writers for w in idle)
+
+
+@responses.activate
+def test_writer_adaptive_split():
+    uploaded = []
+
+    def upload(request):
+        lines = _read_body(request).splitlines()
+        if len(lines) > 3:
+            return 413, {}, 'Request Entity Too Large'
+        start = int(re.search(r'start=(\d+)', request.url).group(1))
+        uploaded.extend((start + i, line) for i, line in enumerate(lines))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', size=10, adaptive=True)
+    try:
+        for x in range(10):
+            writer.write({'x': x})
+        writer.flush()
+    finally:
+        client.close()
+    assert uploaded == [(x, b'{"x": %d}' % x) for x in range(10)]
+    assert writer.size < 10
+    assert writer.stats()['failed_batches'] == 0
+
+
+@responses.activate
+def test_writer_adaptive_latency():
+    _mock_upload('/items/1/2/.*')
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    uploader = client.batchuploader
+    fast = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/3', size=10,
+                                  adaptive=True)
+    slow = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/4', size=10,
+                                  adaptive=True, target_latency=1e-6)
+    static = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/5', size=10)
+    try:
+        for writer in (fast, slow, static):
+            for x in range(10):
+                writer.write({'x': x})
+            writer.flush()
+    finally:
+        client.close()
+    # full and fast batches grow up to the queue size
+    assert fast.size == 15 and fast.max_size == 20
+    assert slow.size == 5
+    assert static.size == 10
+
+
+@responses.activate
+def test_writer_write_many(tmpdir):
+    uploaded = []
+
+    def upload(request):
+        start = int(re.search(r'start=(\d+)', request.url).group(1))
+        lines = _read_body(request).splitlines()
+        uploaded.extend((start + i, line) for i, line in enumerate(lines))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', size=10, spool_dir=str(tmpdir))
+    try:
+        assert writer.write_many([]) == range(0)
+        # more items than the queue holds
+        assert writer.write_many({'x': x} for x in range(95)) == range(95)
+        assert writer.write({'x': 95}) == 95
+        with pytest.raises(ValueTooLarge):
+            writer.write_many([{'x': 96}, {'x': 'x' * writer.maxitemsize}])
+        assert writer.write_many([{'x': 97}]) == range(97, 98)
+        writer.flush()
+    finally:
+        client.close()
+    assert uploaded == [(x, b'{"x": %d}' % x) for x in range(98)]
+    assert writer.stats()['queued_bytes'] == 0
+
+
+@pytest.mark.skipif(not MSGPACK_AVAILABLE, reason='requires msgpack')
+@responses.activate
+def test_writer_msgpack():
+    received = []
+    _mock_upload('/items/1/2/3', lambda request: (
+        received.append(request) or (200, {}, '{}')))
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', content_encoding='gzip',
+        use_msgpack=True)
+    items = [{'x': x, 'ts': datetime(2017, 5, 4, x)} for x in range(10)]
+    try:
+        writer.write_many(items)
+        writer.flush()
+    finally:
+        client.close()
+    [request] = received
+    assert request.headers['Content-Type'] == 'application/x-msgpack'
+    body = zlib.decompress(_read_body(request), 16 + zlib.MAX_WBITS)
+    assert list(mpdecode([body])) == [
+        dict(item, ts=jsondefault(item['ts'])) for item in items]
+
+
+def test_writer_msgpack_spool(tmpdir):
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    try:
+        with pytest.raises(ValueError):
+            client.batchuploader.create_writer(
+                TEST_ENDPOINT + '/items/1/2/3', use_msgpack=True,
+                spool_dir=str(tmpdir))
+    finally:
+        client.close()
+
+
+@responses.activate
+def test_close_timeout_keeps_uploading():
+    uploaded = []
+
+    def upload(request):
+        time.sleep(0.05)
+        uploaded.extend(_read_body(request).splitlines())
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    uploader = client.batchuploader
+    writer = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/3', size=10)
+    writer.write_many({'x': x} for x in range(60))
+    client.close(timeout=0.1)
+    for thread in uploader._threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert len(uploaded) == 60
+    assert writer.itemsq.unfinished_tasks == 0
+
+
+@responses.activate
+def test_writer_encoding_failure(monkeypatch):
+    _mock_upload('/items/1/2/.*')
+
+    def failing(iterable, level=None):
+        next(iter(iterable))
+        raise RuntimeError('broken encoder')
+
+    monkeypatch.setitem(CONTENT_ENCODERS, 'broken', failing)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    uploader = client.batchuploader
+    broken = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/3',
+                                    content_encoding='broken')
+    writer = uploader.create_writer(TEST_ENDPOINT + '/items/1/2/4')
+    try:
+        broken.write_many({'x': x} for x in range(5))
+        broken.flush()
+        stats = broken.stats()
+        # the encoder fails after taking one item from the queue each time
+        assert stats['failed_batches'] == 5
+        assert stats['queued_bytes'] == 0
+        assert 'broken encoder' in stats['last_error']['error']
+        # the worker thread is still alive
+        writer.write({'x': 0})
+        writer.flush()
+        assert writer.stats()['items'] == 1
+    finally:
+        client.close()
+
+
+@pytest.mark.skipif(not ORJSON_AVAILABLE, reason='requires orjson')
+@responses.activate
+def test_writer_sizes_in_bytes():
+    bodies = []
+    _mock_upload('/items/1/2/3', lambda request: (
+        bodies.append(_read_body(request)) or (200, {}, '{}')))
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT,
+                              json_backend='orjson')
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', maxitemsize=100, interval=60)
+    try:
+        # orjson does not escape non ASCII characters
+        with pytest.raises(ValueTooLarge):
+            writer.write({'a': u'\xe9' * 80})
+        writer.write({'a': u'\xe9' * 10})
+        size = writer.queued_bytes
+        writer.flush()
+    finally:
+        client.close()
+    assert bodies == [(u'{"a":"%s"}\n' % (u'\xe9' * 10)).encode('utf8')]
+    assert size == len(bodies[0])
+
+
+@responses.activate
+def test_writer_write_many_concurrent():
+    uploaded = {}
+
+    def upload(request):
+        start = int(request.params['start'])
+        lines = _read_body(request).splitlines()
+        uploaded.update((start + i, line) for i, line in enumerate(lines))
+        return 200, {}, '{}'
+
+    _mock_upload('/items/1/2/3', upload)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT)
+    writer = client.batchuploader.create_writer(
+        TEST_ENDPOINT + '/items/1/2/3', size=10, qsize=15)
+    ranges = {}
+
+    def write(name):
+        ranges[name] = writer.write_many(
+            {'t': name, 'x': x} for x in range(200))
+
+    threads = [threading.Thread(target=write, args=(name,))
+               for name in ('a', 'b', 'c')]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.flush()
+    finally:
+        client.close()
+    assert len(uploaded) == 600
+    for name, offsets in ranges.items():
+        assert [uploaded[o] for o in offsets] == [
+            b'{"t": "%s", "x": %d}' % (name.encode(), x) for x in range(200)]
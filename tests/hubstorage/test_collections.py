@@ -3,12 +3,16 @@ Test Collections
 """
 import random
 from contextlib import closing
+from datetime import datetime
 
 import pytest
+import responses
 from scrapinghub import HubstorageClient
+from scrapinghub.hubstorage.serialization import (
+    MSGPACK_AVAILABLE, jsondefault, mpdecode)
 from six.moves import range
 
-from ..conftest import TEST_COLLECTION_NAME
+from ..conftest import TEST_COLLECTION_NAME, TEST_AUTH, TEST_ENDPOINT
 from .testutil import failing_downloader
 
 
@@ -171,3 +175,54 @@ def test_truncate(hscollection):
 
     hscollection.truncate()
     assert len(list(hscollection.iter_values(prefix='my_key'))) == 0
+
+
+@pytest.mark.skipif(not MSGPACK_AVAILABLE, reason='requires msgpack')
+@responses.activate
+def test_set_msgpack():
+    received = []
+
+    def callback(request):
+        received.append(request)
+        return 200, {}, ''
+
+    responses.add_callback(
+        responses.POST, TEST_ENDPOINT + '/collections/1/s/msgpack_test',
+        callback=callback)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT,
+                              upload_msgpack=True)
+    collection = client.get_project(1).collections.new_store('msgpack_test')
+    values = [{'_key': 'a', 'ts': datetime(2017, 5, 4)}, {'_key': 'b'}]
+    collection.set(values)
+    [request] = received
+    assert request.headers['Content-Type'] == 'application/x-msgpack'
+    assert list(mpdecode([request.body])) == [
+        {'_key': 'a', 'ts': jsondefault(datetime(2017, 5, 4))}, {'_key': 'b'}]
+
+
+@responses.activate
+def test_iter_json_requests_params():
+    received = []
+
+    def callback(request):
+        received.append(request)
+        return 200, {}, '{"_key": "a"}\n{"_key": "b"}\n'
+
+    responses.add_callback(
+        responses.GET, TEST_ENDPOINT + '/collections/1/s/params_test',
+        callback=callback)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT,
+                              use_msgpack=False)
+    collections = client.get_project(1).collections
+    # fail fast on unexpected urls
+    collections.MAX_RETRIES = 1
+    collection = collections.new_store('params_test')
+    lines = collection._collections.iter_json(
+        's', 'params_test', requests_params={'chunk_size': 3}, prefix='a')
+    assert list(lines) == ['{"_key": "a"}', '{"_key": "b"}']
+    assert list(collection._collections.iter_values(
+        's', 'params_test', requests_params={'timeout': 5})) == [
+        {'_key': 'a'}, {'_key': 'b'}]
+    assert [r.url.split('?')[0] for r in received] == [
+        TEST_ENDPOINT + '/collections/1/s/params_test'] * 2
+    assert 'prefix=a' in received[0].url
@@ -1,19 +1,23 @@
 """
 Test Project
 """
+import re
 import six
 import json
 import pytest
+import responses
 from six.moves import range
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, Timeout
 
 from scrapinghub import HubstorageClient
+from scrapinghub.hubstorage.serialization import mpencode
 
 from ..conftest import TEST_PROJECT_ID, TEST_SPIDER_NAME
+from ..conftest import TEST_AUTH, TEST_ENDPOINT
 from .conftest import hsspiderid
 from .conftest import start_job
 from .conftest import set_testbotgroup, unset_testbotgroup
-from .testutil import failing_downloader
+from .testutil import failing_downloader, wrap_seq_to_fail
 
 
 def test_projectid(hsclient):
@@ -298,3 +302,80 @@ def test_allows_msgpack(hsclient, path, expected_result, json_and_msgpack):
     assert job.requests._allows_mpack(path) is False
     assert job.metadata._allows_mpack(path) is False
     assert job.jobq._allows_mpack(path) is False
+
+
+@responses.activate
+def test_iter_values_chunked_lines():
+    lines = [json.dumps({'_key': '1/2/3/%d' % i, 'field': u'v\xe1l' * i})
+             for i in range(20)]
+    requested = []
+
+    def callback(request):
+        requested.append(request.url)
+        start = 0
+        if 'start=' in request.url:
+            start = int(request.url.rsplit('%2F', 1)[1])
+        return 200, {}, '\n'.join(lines[start:]) + '\n'
+
+    responses.add_callback(
+        responses.GET, re.compile(TEST_ENDPOINT + '/items/1/2/3'),
+        callback=callback, content_type='application/x-jsonlines')
+    # lines span several chunks
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT,
+                              use_msgpack=False, chunk_size=7)
+    items = client.get_job('1/2/3').items
+    with failing_downloader(items):
+        downloaded = list(items.iter_values())
+    assert downloaded == [json.loads(line) for line in lines]
+    assert 'start=1%2F2%2F3%2F5' in requested[1]
+    assert list(items.iter_json(requests_params={'chunk_size': 3})) == lines
+
+
+@pytest.mark.parametrize('msgpack', [False, True])
+@responses.activate
+def test_iter_values_offset_resume(msgpack):
+    values = [{'_key': '1/2/3/%d' % i, 'field': i} for i in range(20)]
+    requested = []
+
+    def callback(request):
+        requested.append(request.url)
+        query = six.moves.urllib.parse.urlparse(request.url).query
+        params = six.moves.urllib.parse.parse_qs(query)
+        assert params['meta'] == ['_key']
+        start = 0
+        if 'start' in params:
+            start = int(params['start'][0].rsplit('/', 1)[1])
+        if 'startafter' in params:
+            start = int(params['startafter'][0].rsplit('/', 1)[1]) + 1
+        selected = [v for v in values[start:]
+                    if 'filter' not in params or v['field'] % 2]
+        selected = selected[:int(params.get('count', [len(values)])[0])]
+        if msgpack:
+            body = b''.join(mpencode(v) for v in selected)
+        else:
+            body = ''.join(json.dumps(v) + '\n' for v in selected)
+        return 200, {}, body
+
+    content_type = ('application/x-msgpack' if msgpack
+                    else 'application/x-jsonlines')
+    responses.add_callback(
+        responses.GET, re.compile(TEST_ENDPOINT + '/items/1/2/3'),
+        callback=callback, content_type=content_type)
+    client = HubstorageClient(auth=TEST_AUTH, endpoint=TEST_ENDPOINT,
+                              use_msgpack=msgpack)
+    items = client.get_job('1/2/3').items
+    items.RETRY_INTERVAL = 0
+    iter_name = '_iter_mpdecode' if msgpack else '_iter_lines'
+    setattr(items, iter_name, wrap_seq_to_fail(
+        getattr(items, iter_name), Timeout, 5, 'test error'))
+
+    assert list(items.iter_values(start='1/2/3/2', count=12)) == values[2:14]
+    assert ['start=1%2F2%2F3%2F' + str(i) in url
+            for i, url in zip([2, 7, 12], requested)] == [True] * 3
+    assert 'count=2' in requested[-1]
+
+    # filtered reads fall back to resuming after the last key
+    del requested[:]
+    filtered = list(items.iter_values(filter='["field", ">", 0]'))
+    assert filtered == [v for v in values if v['field'] % 2]
+    assert 'startafter=1%2F2%2F3%2F9' in requested[1]
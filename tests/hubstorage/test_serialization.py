@@ -1,8 +1,13 @@
 """ Serialization utils module.  """
 
+import json
 from datetime import datetime, timedelta, tzinfo
 
-from scrapinghub.hubstorage.serialization import jsondefault
+import pytest
+
+from scrapinghub.hubstorage.serialization import (
+    JSON_BACKENDS, get_json_backend, jldecode, jlencode, jsondefault,
+    jsonencode)
 
 
 def test_jsondefault_timezones():
@@ -19,3 +24,25 @@ def test_jsondefault_timezones():
     dt_tz = dt.replace(tzinfo=TestTZ())
     dt_tz_ts = jsondefault(dt_tz)
     assert dt_tz_ts == dt_ts + 399 * 60 * 1000
+
+
+@pytest.mark.parametrize('name', sorted(JSON_BACKENDS))
+def test_json_backends(name):
+    backend = get_json_backend(name)
+    dt = datetime(2017, 5, 4, 3, 2, 1, 123456)
+    item = {'dt': dt, 'big': 2 ** 70, 'set': {1}, 'text': u'\xe1/b',
+            'nested': [{'a': None}, 1.5, True]}
+    expected = json.loads(jsonencode(item))
+    assert json.loads(backend.dumps(item)) == expected
+    assert backend.loads(jsonencode(item)) == expected
+    assert json.loads(backend.dumps({1: 'x'})) == {'1': 'x'}
+    lines = [jsonencode({'a': 1}), jsonencode({'b': 2})]
+    assert list(jldecode(lines, backend)) == [{'a': 1}, {'b': 2}]
+    assert jlencode([{'a': 1}], backend).startswith('{')
+
+
+def test_get_json_backend():
+    assert get_json_backend().name == 'json'
+    assert get_json_backend('auto').name in JSON_BACKENDS
+    with pytest.raises(ValueError):
+        get_json_backend('unknown')